@@ -11,11 +11,24 @@ import os
 import logging
 import sys
 import re
-from logging.handlers import RotatingFileHandler
-from typing import Dict, List, Union, Optional
+import queue
+import atexit
+import functools
+import string
+from itertools import combinations
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from typing import Dict, List, Union, Optional, Pattern, Tuple
+
+# Background writer for log records, set up by setup_logging()
+_log_listener: Optional[QueueListener] = None
 
 def setup_logging(log_file: str) -> None:
-    """Configure logging with console and rotating file handlers."""
+    """Configure logging with console and rotating file handlers.
+
+    The root logger only gets a QueueHandler; a background QueueListener does
+    the formatting and console/file writes so callers never block on log I/O.
+    """
+    global _log_listener
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
     log_format = logging.Formatter(
@@ -24,7 +37,12 @@ def setup_logging(log_file: str) -> None:
     )
     console_handler = logging.StreamHandler(sys.stderr)
     console_handler.setFormatter(log_format)
-    logger.addHandler(console_handler)
+    log_queue = queue.Queue(-1)
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, console_handler, respect_handler_level=True)
+    listener.start()
+    _log_listener = listener
+    atexit.register(stop_logging)
     logging.info("Console logging initialized")
 
     try:
@@ -39,13 +57,31 @@ def setup_logging(log_file: str) -> None:
         handler = RotatingFileHandler(log_file, maxBytes=5 * 1024 * 1024, backupCount=5)
         handler.setFormatter(log_format)
         handler.setLevel(logging.INFO)
-        logger.addHandler(handler)
-        handler.flush()
+        listener.handlers = listener.handlers + (handler,)
         logging.info("File logging initialized")
     except Exception as e:
         logging.error(f"Failed to initialize file logging: {e}. Continuing with console logging.")
         raise
 
+def stop_logging() -> None:
+    """Stop the background log writer after draining it; later records are written directly."""
+    global _log_listener
+    listener, _log_listener = _log_listener, None
+    if listener is None:
+        return
+    logger = logging.getLogger()
+    # Swap in the real handlers first so records logged while draining aren't lost
+    for handler in listener.handlers:
+        logger.addHandler(handler)
+    for handler in [h for h in logger.handlers if isinstance(h, QueueHandler)]:
+        logger.removeHandler(handler)
+    listener.stop()
+
+@functools.lru_cache(maxsize=128)
+def compile_pattern(pattern: str, flags: int = 0) -> Pattern[str]:
+    """Compile a regex pattern once and reuse it for every later caller."""
+    return re.compile(pattern, flags)
+
 def get_required_env_var(name: str, default: Optional[str] = None) -> str:
     """Retrieve an environment variable with optional default."""
     value = os.getenv(name, default)
@@ -54,26 +90,19 @@ def get_required_env_var(name: str, default: Optional[str] = None) -> str:
         raise ValueError(f"Environment variable {name} must be set")
     return value
 
+_MASK_PATH_RE: Pattern[str] = compile_pattern(r'C:\\Users\\[^\\]+\\[^\'"]+')
+
 def mask_path(path: str) -> str:
     """Mask user paths in log messages."""
-    return re.sub(r'C:\\Users\\[^\\]+\\[^\'"]+', '[REDACTED_PATH]', path)
+    if 'Users' not in path:
+        return path
+    return _MASK_PATH_RE.sub('[REDACTED_PATH]', path)
 
 def mask_traceback(tb: str) -> str:
     """Mask sensitive paths and filenames in traceback."""
-    tb_lines = tb.splitlines()
-    masked_lines = []
-    patterns_to_mask = [
-        re.compile(pattern, re.IGNORECASE)
-        for template in TEMPLATES.values()
-        for pattern in [template["pattern"]]
-    ]
-    for line in tb_lines:
-        line = re.sub(r'C:\\Users\\[^\\]+\\[^\'"]+', '[REDACTED_PATH]', line)
-        for pattern in patterns_to_mask:
-            line = re.sub(pattern, '[REDACTED_FILE]', line)
-        line = re.sub(r'[^\'"]+\.pdf', '[REDACTED_FILE]', line)
-        masked_lines.append(line)
-    return '\n'.join(masked_lines)
+    for pattern, replacement in _MASK_STEPS:
+        tb = pattern.sub(replacement, tb)
+    return tb
 
 # Initialize logging
 LOG_FILE = get_required_env_var("PDF_WATCHER_LOG_DIRECTORY")
@@ -100,9 +129,23 @@ PDF_RENAME_FORMAT = get_required_env_var("PDF_RENAME_FORMAT", "{base}_{timestamp
 if "{base}" not in PDF_RENAME_FORMAT or "{timestamp}" not in PDF_RENAME_FORMAT:
     logging.error("PDF_RENAME_FORMAT must contain {base} and {timestamp} placeholders")
     raise ValueError("Invalid PDF_RENAME_FORMAT")
+# Parse the rename format once into (literal, field) pairs for render_rename
+_RENAME_PARTS: List[Tuple[str, Optional[str]]] = []
+for literal, field, format_spec, conversion in string.Formatter().parse(PDF_RENAME_FORMAT):
+    if field is not None and (field not in ("base", "timestamp") or format_spec or conversion):
+        logging.error("PDF_RENAME_FORMAT may only use plain {base} and {timestamp} placeholders")
+        raise ValueError("Invalid PDF_RENAME_FORMAT")
+    _RENAME_PARTS.append((literal, field))
+
+def render_rename(base: str, timestamp: str) -> str:
+    """Build a renamed PDF filename from the pre-parsed PDF_RENAME_FORMAT."""
+    values = {"base": base, "timestamp": timestamp, None: ""}
+    return "".join(literal + values[field] for literal, field in _RENAME_PARTS)
+
+PDF_FULL_VALIDATION = get_required_env_var("PDF_FULL_VALIDATION", "false").lower() in ("1", "true", "yes")
 
 # Template configuration
-TEMPLATES: Dict[str, Dict[str, Union[str, List[str]]]] = {
+TEMPLATES: Dict[str, Dict[str, Union[str, List[str], Pattern[str]]]] = {
     "WireTransfer": {
         "pattern": get_required_env_var("WIRE_XFER_PDF_PATTERN"),
         "email_to": get_required_env_var("WIRE_XFER_EMAIL_TO").split(","),
@@ -117,24 +160,38 @@ TEMPLATES: Dict[str, Dict[str, Union[str, List[str]]]] = {
     }
 }
 
-# Validate templates
+# Validate and precompile templates
 for template_name, template in TEMPLATES.items():
     try:
-        re.compile(template["pattern"])
+        template["compiled"] = compile_pattern(template["pattern"])
+        # Case-insensitive copy for masking filenames in tracebacks
+        template["mask_compiled"] = compile_pattern(template["pattern"], re.IGNORECASE | re.MULTILINE)
     except re.error as e:
         logging.error(f"Invalid regex pattern for {template_name}: {e}")
         raise ValueError(f"Invalid regex pattern for {template_name}")
 
+# (name, compiled pattern, template) triples for matching incoming filenames
+COMPILED_TEMPLATES: Tuple[Tuple[str, Pattern[str], Dict], ...] = tuple(
+    (name, tmpl["compiled"], tmpl) for name, tmpl in TEMPLATES.items()
+)
+
+# (pattern, replacement) pairs applied in order by mask_traceback: user paths first,
+# then template filenames, then any other PDF name. Templates stay separate patterns
+# so inline flags, named groups and backreferences in each one keep working.
+# The fixed patterns exclude newlines so a match never spans traceback lines.
+_MASK_STEPS: Tuple[Tuple[Pattern[str], str], ...] = (
+    (compile_pattern(r'C:\\Users\\[^\\\n]+\\[^\'"\n]+', re.IGNORECASE), '[REDACTED_PATH]'),
+    *((template["mask_compiled"], '[REDACTED_FILE]') for template in TEMPLATES.values()),
+    (compile_pattern(r'[^\'"\n]+\.pdf', re.IGNORECASE), '[REDACTED_FILE]'),
+)
+
 # Check for overlapping regex patterns
 def check_template_conflicts():
     """Ensure no two templates can match the same filename."""
-    for t1_name, t1 in TEMPLATES.items():
-        for t2_name, t2 in TEMPLATES.items():
-            if t1_name < t2_name:  # Avoid comparing same template or reverse pairs
-                p1, p2 = re.compile(t1["pattern"]), re.compile(t2["pattern"])
-                test_string = "sample_filename.pdf"
-                if p1.search(test_string) and p2.search(test_string):
-                    logging.warning(f"Potential regex overlap between {t1_name} and {t2_name}")
+    test_string = "sample_filename.pdf"
+    for (t1_name, p1, _), (t2_name, p2, _) in combinations(COMPILED_TEMPLATES, 2):
+        if p1.search(test_string) and p2.search(test_string):
+            logging.warning(f"Potential regex overlap between {t1_name} and {t2_name}")
 check_template_conflicts()
 
 # Log loaded configuration (non-sensitive data only)
@@ -145,4 +202,5 @@ logging.info(f"CSV_FILE: {mask_path(CSV_FILE)}")
 logging.info(f"SMTP_PORT: {SMTP_PORT}")
 logging.info(f"EMAIL_DOMAIN: {EMAIL_DOMAIN}")
 logging.info(f"PDF_RENAME_FORMAT: {PDF_RENAME_FORMAT}")
+logging.info(f"PDF_FULL_VALIDATION: {PDF_FULL_VALIDATION}")
 logging.info("Template configurations loaded (details redacted for security)")
@@ -13,9 +13,15 @@ import os
 import html
 import logging
 import time
-from typing import Optional, List
+import atexit
+import queue
+import functools
+import hashlib
+from threading import Lock, Thread
+from typing import Optional, List, Dict, Tuple
 from config import mask_path
 
+@functools.lru_cache(maxsize=256)
 def mask_email(email: str) -> str:
     """Mask email addresses for logging to prevent PII exposure."""
     local_part, domain = email.split('@')
@@ -25,6 +31,82 @@ def mask_email(email: str) -> str:
         masked_local = local_part[:2] + '...' + local_part[-1]
     return f"{masked_local}@{domain}"
 
+@functools.lru_cache(maxsize=256)
+def _escape(text: str) -> str:
+    """html.escape, cached for the recurring alert subjects and bodies."""
+    return html.escape(text)
+
+class SMTPConnection:
+    """Lazily connected SMTP client that can be reused across send_email calls."""
+    def __init__(self, smtp_server: str, smtp_port: int, use_ssl: bool = False, timeout: int = 10):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.lock = Lock()  # Held by callers for the whole get() + send_message() exchange
+        self._server: Optional[smtplib.SMTP] = None
+
+    def get(self) -> smtplib.SMTP:
+        """Return the cached connection, reconnecting if the server dropped it."""
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.close()
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+            try:
+                server.starttls()
+            except Exception:
+                server.close()
+                raise
+        self._server = server
+        return server
+
+    def close(self) -> None:
+        """Close the cached connection, ignoring errors from an already-dead socket."""
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+class _SMTPPool:
+    """Process-wide SMTPConnection per (server, port, SSL) so every sender shares one session."""
+    def __init__(self):
+        self._connections: Dict[Tuple[str, int, bool], SMTPConnection] = {}
+        self._lock = Lock()
+
+    def get(self, smtp_server: str, smtp_port: int, use_ssl: bool) -> SMTPConnection:
+        """Return the pooled connection for this server, creating it on first use."""
+        key = (smtp_server, smtp_port, use_ssl)
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = SMTPConnection(smtp_server, smtp_port, use_ssl=use_ssl)
+                self._connections[key] = connection
+            return connection
+
+    def close(self) -> None:
+        """Close all pooled connections."""
+        with self._lock:
+            connections = list(self._connections.values())
+        for connection in connections:
+            with connection.lock:
+                connection.close()
+
+_pool = _SMTPPool()
+atexit.register(_pool.close)
+
+def close_smtp_connections() -> None:
+    """Close pooled SMTP connections, e.g. when the service stops."""
+    _pool.close()
+
 def send_email(
     smtp_server: str,
     smtp_port: int,
@@ -36,11 +118,14 @@ def send_email(
     use_ssl: bool = False,
     is_html: bool = False,
     cc_addrs: Optional[List[str]] = None
-) -> None:
-    """Send an email with optional attachment."""
+) -> bool:
+    """Send an email with optional attachment over the pooled SMTP connection.
+
+    Returns True if the message was accepted by the server.
+    """
     # Sanitize inputs to prevent injection
-    subject = html.escape(subject)
-    body = html.escape(body) if not is_html else body
+    subject = _escape(subject)
+    body = _escape(body) if not is_html else body
 
     msg = EmailMessage()
     msg["From"] = from_addr
@@ -66,26 +151,112 @@ def send_email(
             logging.info(f"Attached {mask_path(attachment)} to email")
         except Exception as e:
             logging.error(f"Failed to attach {mask_path(attachment)}: {e}")
-            return
+            return False
 
     # Attempt to send email with retries
-    masked_to_addrs = [mask_email(addr) for addr in to_addrs]
-    masked_cc_addrs = [mask_email(addr) for addr in cc_addrs] if cc_addrs else []
+    masked_to_addrs = tuple(mask_email(addr) for addr in to_addrs)
+    masked_cc_addrs = tuple(mask_email(addr) for addr in cc_addrs) if cc_addrs else ()
+    connection = _pool.get(smtp_server, smtp_port, use_ssl)
     for attempt in range(3):
         try:
-            if use_ssl:
-                with smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=10) as server:
-                    server.send_message(msg)
-            else:
-                with smtplib.SMTP(smtp_server, smtp_port, timeout=10) as server:
-                    server.starttls()
-                    server.send_message(msg)
+            with connection.lock:
+                try:
+                    connection.get().send_message(msg)
+                except (smtplib.SMTPServerDisconnected, TimeoutError, ConnectionError):
+                    # Only a broken session needs a reconnect on the next attempt
+                    connection.close()
+                    raise
             if masked_cc_addrs:
                 logging.info(f"Email sent to {', '.join(masked_to_addrs)} with CC to {', '.join(masked_cc_addrs)}")
             else:
                 logging.info(f"Email sent to {', '.join(masked_to_addrs)}")
-            return
+            return True
         except Exception as e:
             logging.warning(f"Email send attempt {attempt+1} failed: {e}")
             time.sleep(2)
     logging.error("Failed to send email after 3 attempts")
+    return False
+
+# Background delivery so callers never wait on SMTP (up to 3 x 10 s on a slow server)
+_mail_queue: "queue.Queue[Tuple[tuple, dict, str]]" = queue.Queue(maxsize=256)
+
+# Queued (alert) emails only: content hash -> monotonic time of the last successful send,
+# so an alert storm doesn't repeat the same SMTP dialog
+_recent_sends: Dict[str, float] = {}
+_recent_sends_lock = Lock()
+DEBOUNCE_WINDOW = 60  # Seconds an identical queued email is suppressed for
+DEBOUNCE_RETENTION = 300  # Seconds before a recorded send is pruned
+_last_debounce_prune = time.monotonic()
+
+def _debounce_key(
+    smtp_server: str,
+    smtp_port: int,
+    from_addr: str,
+    to_addrs: List[str],
+    subject: str,
+    body: str,
+    attachment: Optional[str] = None,
+    use_ssl: bool = False,
+    is_html: bool = False,
+    cc_addrs: Optional[List[str]] = None
+) -> str:
+    """Hash the content of an email; takes the same arguments as send_email."""
+    return hashlib.blake2b(
+        "|".join((subject, body, ",".join(to_addrs), ",".join(cc_addrs or ()), attachment or "")).encode(),
+        digest_size=16
+    ).hexdigest()
+
+def _sent_recently(key: str) -> bool:
+    """Return True if an identical queued email was sent within DEBOUNCE_WINDOW."""
+    with _recent_sends_lock:
+        last_sent = _recent_sends.get(key)
+    return last_sent is not None and time.monotonic() - last_sent < DEBOUNCE_WINDOW
+
+def _record_send(key: str) -> None:
+    """Remember a successful send, pruning old entries every DEBOUNCE_RETENTION seconds."""
+    global _last_debounce_prune
+    now = time.monotonic()
+    with _recent_sends_lock:
+        _recent_sends[key] = now
+        if now - _last_debounce_prune >= DEBOUNCE_RETENTION:
+            for stale_key in [k for k, t in _recent_sends.items() if now - t >= DEBOUNCE_RETENTION]:
+                del _recent_sends[stale_key]
+            _last_debounce_prune = now
+
+def _mail_worker() -> None:
+    """Send queued emails one at a time for the life of the process."""
+    while True:
+        args, kwargs, key = _mail_queue.get()
+        try:
+            if _sent_recently(key):
+                logging.info(f"Suppressed duplicate queued email (identical one sent within {DEBOUNCE_WINDOW}s)")
+            elif send_email(*args, **kwargs):
+                _record_send(key)
+        except Exception as e:
+            logging.error(f"Unexpected error sending queued email: {e}")
+        finally:
+            _mail_queue.task_done()
+
+Thread(target=_mail_worker, name="email-worker", daemon=True).start()
+
+def enqueue_email(*args, **kwargs) -> None:
+    """Queue an email for background delivery; takes the same arguments as send_email.
+
+    An email identical to one successfully sent in the last DEBOUNCE_WINDOW seconds is skipped.
+    """
+    try:
+        _mail_queue.put_nowait((args, kwargs, _debounce_key(*args, **kwargs)))
+    except queue.Full:
+        logging.error("Email queue full, dropping email")
+
+def flush_email_queue(timeout: float = 30.0) -> bool:
+    """Wait until queued emails have been sent. Returns False if the timeout expires first."""
+    deadline = time.monotonic() + timeout
+    with _mail_queue.all_tasks_done:
+        while _mail_queue.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.warning(f"Timed out waiting for {_mail_queue.unfinished_tasks} queued emails")
+                return False
+            _mail_queue.all_tasks_done.wait(remaining)
+    return True
@@ -10,16 +10,57 @@ Last Modified: 5/29/2025
 import shutil
 import time
 import os
+import sys
 import logging
-from typing import Union
+import functools
+from threading import Lock
+from typing import Union, Dict, Optional, Tuple
 from PyPDF2 import PdfReader
-from config import mask_path
+from config import mask_path, PDF_FULL_VALIDATION
+
+# is_pdf results keyed by the source file's (path, mtime_ns, size), so replayed
+# events for an unchanged file skip re-validating its temp copy
+PDF_VALIDATION_CACHE: Dict[Tuple[str, int, int], bool] = {}
+PDF_VALIDATION_CACHE_SIZE = 256
+_pdf_validation_cache_lock = Lock()  # Validation runs on the handler's executor threads
+
+def _fast_copy(src: str, dest: str) -> None:
+    """Copy a file using an in-kernel copy where available, falling back to shutil.copy."""
+    if sys.platform == "win32" or not hasattr(os, "sendfile"):
+        # shutil.copyfile already uses the platform's fast copy path here
+        shutil.copyfile(src, dest)
+        shutil.copymode(src, dest)
+        return
+    try:
+        with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+            in_fd, out_fd = fsrc.fileno(), fdst.fileno()
+            remaining = os.fstat(in_fd).st_size
+            use_copy_file_range = hasattr(os, "copy_file_range")
+            while remaining > 0:
+                if use_copy_file_range:
+                    try:
+                        sent = os.copy_file_range(in_fd, out_fd, remaining)
+                    except OSError:
+                        # e.g. cross-device copy on older kernels; continue with sendfile
+                        use_copy_file_range = False
+                        continue
+                else:
+                    sent = os.sendfile(out_fd, in_fd, None, remaining)
+                if sent == 0:
+                    break
+                remaining -= sent
+        shutil.copymode(src, dest)
+    except PermissionError:
+        raise
+    except OSError as e:
+        logging.warning(f"Fast copy of {mask_path(src)} failed, falling back to shutil.copy: {e}")
+        shutil.copy(src, dest)
 
 def copy_file_with_retries(src: str, dest: str, retries: int = 5, delay: int = 1) -> bool:
     """Copy a file with retries on permission errors."""
     for attempt in range(retries):
         try:
-            shutil.copy(src, dest)
+            _fast_copy(src, dest)
             logging.info(f"Successfully copied file from {mask_path(src)} to {mask_path(dest)}")
             return True
         except PermissionError as e:
@@ -31,31 +72,88 @@ def copy_file_with_retries(src: str, dest: str, retries: int = 5, delay: int = 1
     logging.error(f"Failed to copy {mask_path(src)} to {mask_path(dest)} after {retries} attempts")
     return False
 
-def is_pdf(file_path: str) -> bool:
-    """Check if a file is a valid PDF by magic number and structure."""
+def is_pdf(file_path: str, full_parse: bool = PDF_FULL_VALIDATION) -> bool:
+    """Check if a file is a valid PDF by magic number and trailer (or full parse if requested)."""
     try:
-        with open(file_path, 'rb') as f:
-            if f.read(4) != b'%PDF':
+        # Raw descriptor reads avoid the buffered-IO wrapper for the common 4-byte rejection
+        fd = os.open(file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            if os.read(fd, 4) != b'%PDF':
                 logging.warning(f"File {mask_path(file_path)} does not have PDF magic number")
                 return False
-        with open(file_path, 'rb') as f:
-            PdfReader(f)
+            if full_parse:
+                os.lseek(fd, 0, os.SEEK_SET)
+                with os.fdopen(fd, 'rb', closefd=False) as f:
+                    PdfReader(f)
+            else:
+                # A complete PDF ends with "startxref <offset> %%EOF"; a partially
+                # written file from the watch directory will not have it yet
+                size = os.lseek(fd, 0, os.SEEK_END)
+                os.lseek(fd, max(size - 1024, 0), os.SEEK_SET)
+                tail = os.read(fd, 1024)
+                eof_pos = tail.rfind(b'%%EOF')
+                if eof_pos == -1 or b'startxref' not in tail[:eof_pos]:
+                    logging.warning(f"File {mask_path(file_path)} is missing a PDF trailer")
+                    return False
+        finally:
+            os.close(fd)
         logging.info(f"Validated {mask_path(file_path)} as a PDF")
         return True
     except Exception as e:
         logging.warning(f"File {mask_path(file_path)} is not a valid PDF: {e}")
         return False
 
+def file_cache_key(file_path: str) -> Optional[Tuple[str, int, int]]:
+    """Return a (path, mtime_ns, size) key for a file, or None if it can't be stat'd."""
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return (file_path, st.st_mtime_ns, st.st_size)
+
+def is_pdf_cached(file_path: str, cache_key: Optional[Tuple[str, int, int]]) -> bool:
+    """Run is_pdf on file_path, memoized on cache_key (see file_cache_key).
+
+    The key should be taken from the source file before it is copied, so a
+    file that was still being written gets a new key once it changes.
+    """
+    if cache_key is None:
+        return is_pdf(file_path)
+    with _pdf_validation_cache_lock:
+        result = PDF_VALIDATION_CACHE.get(cache_key)
+    if result is not None:
+        logging.info(f"Using cached PDF validation result for {mask_path(file_path)}")
+        return result
+    # Validate outside the lock so a slow parse doesn't hold up the other workers
+    result = is_pdf(file_path)
+    with _pdf_validation_cache_lock:
+        PDF_VALIDATION_CACHE[cache_key] = result
+        if len(PDF_VALIDATION_CACHE) > PDF_VALIDATION_CACHE_SIZE:
+            del PDF_VALIDATION_CACHE[next(iter(PDF_VALIDATION_CACHE))]
+    return result
+
+@functools.lru_cache(maxsize=16)
+def _abs_base_dir(base_dir: str) -> str:
+    """Resolve and normalize a base directory once; base dirs are fixed config values."""
+    return os.path.normcase(os.path.abspath(base_dir))
+
 def validate_safe_path(base_dir: str, file_path: str) -> bool:
-    """Validate that a file path is within the expected directory (prevent path traversal)."""
+    """Validate that a file path is within the expected directory (prevent path traversal).
+
+    Both paths are absolutized and normcase'd (lowercased with backslashes on
+    Windows), so the prefix check below is equivalent to the commonpath test
+    on case-insensitive filesystems.
+    """
     try:
-        # Get absolute paths
-        base_dir = os.path.abspath(base_dir)
+        # Get absolute paths (case-normalized copies are only used for the comparison)
         file_path = os.path.abspath(file_path)
+        norm_base = _abs_base_dir(base_dir)
+        norm_file = os.path.normcase(file_path)
         
-        # Check if file_path is within base_dir
-        common_path = os.path.commonpath([base_dir, file_path])
-        is_safe = common_path == base_dir
+        # Check if file_path is within base_dir; the trailing separator stops
+        # C:\watch from matching a sibling like C:\watch2
+        base_prefix = norm_base if norm_base.endswith(os.sep) else norm_base + os.sep
+        is_safe = norm_file == norm_base or norm_file.startswith(base_prefix)
         
         if not is_safe:
             logging.warning(f"Path traversal attempt detected: {mask_path(file_path)} not in {mask_path(base_dir)}")
@@ -10,22 +10,21 @@ Last Modified: 5/29/2025
 import os
 import time
 import logging
-import re
 import traceback
 import uuid
 import shutil
 import html
 import tempfile
+from collections import deque, OrderedDict
 from datetime import datetime
 from watchdog.events import FileSystemEventHandler
-from queue import Queue, Empty, Full
-from threading import Thread, Lock
+from threading import Lock
 from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List
-from file_handler import copy_file_with_retries, is_pdf, validate_safe_path
-from email_utils import send_email
-from config import TEMPLATES, mask_traceback, mask_path, PDF_RENAME_FORMAT, ERROR_EMAIL_TO, WATCH_DIR
-from xml_handler import find_companion_xml, get_user_email_from_xml
+from file_handler import copy_file_with_retries, is_pdf_cached, file_cache_key, validate_safe_path
+from email_utils import send_email, enqueue_email
+from config import COMPILED_TEMPLATES, mask_traceback, mask_path, render_rename, ERROR_EMAIL_TO, WATCH_DIR
+from xml_handler import find_companion_xml, get_user_email_from_companion_xml
 
 def mask_filename(filename: str) -> str:
     """Mask entire PDF filename, preserving only the extension."""
@@ -39,106 +38,129 @@ class WirePDFHandler(FileSystemEventHandler):
         self.email_from = email_from
         self.smtp_server = smtp_server
         self.smtp_port = smtp_port
-        self.recent_filenames = {}
-        self.event_queue = Queue(maxsize=100)  # Max queue size
-        self.queue_lock = Lock()
+        # Insertion-ordered by send time, so expired entries are always at the front
+        self.recent_filenames: "OrderedDict[str, float]" = OrderedDict()
+        self.recent_lock = Lock()  # Guards recent_filenames (workers insert, the main loop expires)
+        self.recent_ttl = 3600
+        self.recent_max_entries = 10_000
+        self.max_pending_events = 100  # Events queued or running in the executor
+        self.pending_events = 0
+        self.pending_lock = Lock()  # Guards pending_events and the processing time stats
         self.email_rate_limit = 60
         self.email_count = 0
-        self.last_reset_time = time.time()
-        self.processing_thread = Thread(target=self.process_queue, daemon=True)
+        self.last_reset_time = time.monotonic()
+        self.alert_interval = 300  # Minimum seconds between repeated alert emails
+        self._last_queue_alert = float('-inf')
+        self._last_disk_alert = float('-inf')
         self.executor = ThreadPoolExecutor(max_workers=4)  # Parallel processing
-        self.processing_times = []
-        self.processing_thread.start()
+        # Separate pool so temp cleanup neither queues behind PDF events nor blocks the caller
+        self.cleanup_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="temp-cleanup")
+        self.processing_times = deque(maxlen=100)
+        self._times_sum = 0.0  # Running sum of processing_times for O(1) averaging
 
     def cleanup_recent_filenames(self) -> None:
         """Remove filenames older than 1 hour."""
-        current_time = time.time()
-        self.recent_filenames = {
-            fname: t for fname, t in self.recent_filenames.items()
-            if current_time - t < 3600
-        }
+        current_time = time.monotonic()
+        with self.recent_lock:
+            while self.recent_filenames:
+                oldest_time = next(iter(self.recent_filenames.values()))
+                if current_time - oldest_time < self.recent_ttl:
+                    break
+                self.recent_filenames.popitem(last=False)
 
     def cleanup_temp_dir(self) -> None:
         """Clean up temporary directories with retries."""
         try:
             total, used, free = shutil.disk_usage(self.temp_dir)
-            if free < 1 * 1024 * 1024 * 1024:
-                send_email(
+            if free < 1 * 1024 * 1024 * 1024 and time.monotonic() - self._last_disk_alert >= self.alert_interval:
+                self._last_disk_alert = time.monotonic()
+                enqueue_email(
                     self.smtp_server, self.smtp_port, self.email_from, ERROR_EMAIL_TO,
                     "Low Disk Space Alert",
                     f"Free disk space on {mask_path(self.temp_dir)} is below 1 GB: {free / (1024 * 1024):.2f} MB",
                     use_ssl=(self.smtp_port == 465)
                 )
-            for subdir in os.listdir(self.temp_dir):
-                subdir_path = os.path.join(self.temp_dir, subdir)
-                if os.path.isdir(subdir_path):
-                    for attempt in range(3):
-                        try:
-                            file_age = time.time() - os.path.getmtime(subdir_path)
-                            shutil.rmtree(subdir_path, ignore_errors=False)
-                            logging.info(f"Deleted temp subdir: {mask_path(subdir_path)}")
-                            break
-                        except Exception as e:
-                            logging.warning(f"Attempt {attempt+1} failed to delete {mask_path(subdir_path)}: {e}")
-                            time.sleep(1)
-                    else:
-                        logging.error(f"Failed to delete {mask_path(subdir_path)} after 3 attempts, age: {file_age/3600:.2f} hours")
+            with os.scandir(self.temp_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        file_age = time.time() - entry.stat(follow_symlinks=False).st_mtime
+                        # Not awaited: retry sleeps on a locked folder must not stall the service loop
+                        self.cleanup_executor.submit(self._rmtree_with_retries, entry.path, file_age)
         except Exception as e:
             tb = mask_traceback(traceback.format_exc())
             logging.error(f"Error during temp directory cleanup: {e}\n{tb}")
 
+    def _rmtree_with_retries(self, subdir_path: str, file_age: float) -> bool:
+        """Delete a temp subdirectory, retrying up to 3 times. Never raises."""
+        for attempt in range(3):
+            try:
+                shutil.rmtree(subdir_path, ignore_errors=False)
+                logging.info(f"Deleted temp subdir: {mask_path(subdir_path)}")
+                return True
+            except Exception as e:
+                logging.warning(f"Attempt {attempt+1} failed to delete {mask_path(subdir_path)}: {e}")
+                time.sleep(1)
+        logging.error(f"Failed to delete {mask_path(subdir_path)} after 3 attempts, age: {file_age/3600:.2f} hours")
+        return False
+
     def on_created(self, event) -> None:
         """Handle new file creation events."""
         if not event.is_directory and event.src_path.lower().endswith(".pdf"):
             logging.info(f"Detected new PDF event: {mask_filename(os.path.basename(event.src_path))}")
-            with self.queue_lock:
-                try:
-                    self.event_queue.put_nowait(event)
-                except Full:
-                    send_email(
-                        self.smtp_server, self.smtp_port, self.email_from, ERROR_EMAIL_TO,
-                        "PDF Watcher Queue Full",
-                        "Event queue is full, new events are being dropped.",
-                        use_ssl=(self.smtp_port == 465)
-                    )
-                    logging.error("Event queue full, dropping event")
-
-    def process_queue(self) -> None:
-        """Process queued PDF events."""
-        while True:
-            try:
-                with self.queue_lock:
-                    if self.event_queue.qsize() > 50:
-                        send_email(
-                            self.smtp_server, self.smtp_port, self.email_from, ERROR_EMAIL_TO,
-                            "PDF Watcher Queue Alert",
-                            f"Queue size exceeded 50 items: {self.event_queue.qsize()}.",
-                            use_ssl=(self.smtp_port == 465)
-                        )
-                event = self.event_queue.get(timeout=1.0)
-                start_time = time.time()
-                self.executor.submit(self.process_pdf_event, event)
-                self.event_queue.task_done()
-                processing_time = time.time() - start_time
+            with self.pending_lock:
+                queue_full = self.pending_events >= self.max_pending_events
+                if not queue_full:
+                    self.pending_events += 1
+                queue_size = self.pending_events
+            if queue_full:
+                enqueue_email(
+                    self.smtp_server, self.smtp_port, self.email_from, ERROR_EMAIL_TO,
+                    "PDF Watcher Queue Full",
+                    "Event queue is full, new events are being dropped.",
+                    use_ssl=(self.smtp_port == 465)
+                )
+                logging.error("Event queue full, dropping event")
+                return
+            # Rate-limited so a sustained backlog doesn't send an alert per event
+            if queue_size > 50 and time.monotonic() - self._last_queue_alert >= self.alert_interval:
+                self._last_queue_alert = time.monotonic()
+                enqueue_email(
+                    self.smtp_server, self.smtp_port, self.email_from, ERROR_EMAIL_TO,
+                    "PDF Watcher Queue Alert",
+                    f"Queue size exceeded 50 items: {queue_size}.",
+                    use_ssl=(self.smtp_port == 465)
+                )
+            self.executor.submit(self.run_pdf_event, event)
+
+    def run_pdf_event(self, event) -> None:
+        """Process a PDF event on an executor thread and record its timing."""
+        start_time = time.monotonic()
+        try:
+            self.process_pdf_event(event)
+        except Exception as e:
+            tb = mask_traceback(traceback.format_exc())
+            logging.error(f"Error in event processing: {e}\n{tb}")
+        finally:
+            processing_time = time.monotonic() - start_time
+            with self.pending_lock:
+                self.pending_events -= 1
+                if len(self.processing_times) == self.processing_times.maxlen:
+                    self._times_sum -= self.processing_times[0]
                 self.processing_times.append(processing_time)
-                if len(self.processing_times) > 100:
-                    self.processing_times.pop(0)
-                avg_time = sum(self.processing_times) / len(self.processing_times) if self.processing_times else 0
-                logging.info(f"Processed event in {processing_time:.2f}s, avg: {avg_time:.2f}s")
-            except Empty:
-                continue
-            except Exception as e:
-                tb = mask_traceback(traceback.format_exc())
-                logging.error(f"Error in queue processing: {e}\n{tb}")
+                self._times_sum += processing_time
+                avg_time = self._times_sum / len(self.processing_times)
+            logging.info(f"Processed event in {processing_time:.2f}s, avg: {avg_time:.2f}s")
 
     def process_pdf_event(self, event) -> None:
         """Process a single PDF event."""
         original_path = event.src_path
         filename = os.path.basename(original_path)
         masked_filename = mask_filename(filename)
-        current_time = time.time()
+        current_time = time.monotonic()
 
-        if filename in self.recent_filenames:
+        with self.recent_lock:
+            last_seen = self.recent_filenames.get(filename)
+        if last_seen is not None and current_time - last_seen < self.recent_ttl:
             logging.info(f"Ignored recently processed file: {masked_filename}")
             return
 
@@ -154,7 +176,7 @@ class WirePDFHandler(FileSystemEventHandler):
             logging.info(f"Processing a new PDF: {masked_filename}")
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             base_name = os.path.splitext(filename)[0]
-            new_name = PDF_RENAME_FORMAT.format(base=base_name, timestamp=timestamp)
+            new_name = render_rename(base_name, timestamp)
             masked_new_name = mask_filename(new_name)
 
             # Validate path safety
@@ -168,6 +190,8 @@ class WirePDFHandler(FileSystemEventHandler):
             logging.info(f"Created secure temp subfolder: {mask_path(temp_subdir)}")
 
             dest_path = os.path.join(temp_subdir, new_name)
+            # Taken before the copy so a still-growing source can't pin a stale result
+            source_key = file_cache_key(original_path)
             if copy_file_with_retries(original_path, dest_path):
                 logging.info(f"Copied PDF to temp: {masked_new_name}")
             else:
@@ -188,15 +212,15 @@ class WirePDFHandler(FileSystemEventHandler):
                     logging.warning(f"Failed to copy XML file: {mask_filename(xml_filename)}")
                     xml_dest_path = None
 
-            if not is_pdf(dest_path):
+            if not is_pdf_cached(dest_path, source_key):
                 logging.warning(f"Temp file is not a valid PDF, skipping: {masked_new_name}")
                 return
 
             matches = []
-            for template_name, template in TEMPLATES.items():
-                pattern = re.compile(template["pattern"])
-                if pattern.search(new_name):
-                    matches.append((template_name, template))
+            for template_name, compiled, template in COMPILED_TEMPLATES:
+                match = compiled.search(new_name)
+                if match:
+                    matches.append((template_name, template, match))
             if len(matches) > 1:
                 logging.warning(f"Multiple template matches for {masked_new_name}: {', '.join(m[0] for m in matches)}")
                 return
@@ -204,8 +228,7 @@ class WirePDFHandler(FileSystemEventHandler):
                 logging.warning(f"No matching template found for file: {masked_new_name}")
                 return
 
-            template_name, template = matches[0]
-            match = re.search(template["pattern"], new_name)
+            template_name, template, match = matches[0]
             email_to = template["email_to"]
             # Sanitize regex groups before formatting
             sanitized_groups = tuple(html.escape(str(g)) for g in match.groups())
@@ -215,7 +238,14 @@ class WirePDFHandler(FileSystemEventHandler):
             # Extract user email from XML if available
             cc_addrs = None
             if xml_dest_path:
-                user_email = get_user_email_from_xml(dest_path)  # Use PDF path to find XML
+                try:
+                    # Parse the temp copy directly; the renamed PDF no longer shares its stem
+                    user_email = get_user_email_from_companion_xml(xml_dest_path)
+                except Exception as e:
+                    # A bug in XML extraction shouldn't stop the PDF email; send it without CC
+                    tb = mask_traceback(traceback.format_exc())
+                    logging.error(f"Unexpected error extracting user email from XML: {e}\n{tb}")
+                    user_email = None
                 if user_email:
                     cc_addrs = [user_email]
                     logging.info("Extracted user email from XML for CC")
@@ -233,7 +263,12 @@ class WirePDFHandler(FileSystemEventHandler):
                     subject, body, attachment=dest_path, use_ssl=(self.smtp_port == 465), cc_addrs=cc_addrs
                 )
                 logging.info(f"Email sent with attachment (template: {template_name}) for {masked_new_name}")
-                self.recent_filenames[filename] = current_time
+                # Stamp with the send time, not the event start, so values stay in insertion order
+                with self.recent_lock:
+                    self.recent_filenames[filename] = time.monotonic()
+                    self.recent_filenames.move_to_end(filename)
+                    if len(self.recent_filenames) > self.recent_max_entries:
+                        self.recent_filenames.popitem(last=False)
                 self.email_count += 1
         except Exception as e:
             tb = mask_traceback(traceback.format_exc())
@@ -14,18 +14,21 @@ import servicemanager
 import win32event
 import win32service
 import win32serviceutil
-from datetime import datetime
 from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
 import win32con
 import win32api
+import win32file
+import win32process
 import traceback
 import os
-import psutil
 import csv
-from typing import Optional
-from config import WATCH_DIR, TEMP_DIR, SMTP_SERVER, SMTP_PORT, EMAIL_FROM, ERROR_EMAIL_TO, CSV_FILE, mask_traceback, mask_path
+from collections import deque
+from threading import Lock
+from typing import Optional, List, Tuple, Deque
+from config import WATCH_DIR, TEMP_DIR, SMTP_SERVER, SMTP_PORT, EMAIL_FROM, ERROR_EMAIL_TO, CSV_FILE, mask_traceback, mask_path, stop_logging
 from pdf_handler import WirePDFHandler
-from email_utils import send_email
+from email_utils import enqueue_email, flush_email_queue, close_smtp_connections
 
 class ResourceMonitor:
     """Handles CPU and memory usage logging with alerts."""
@@ -33,23 +36,50 @@ class ResourceMonitor:
         self.csv_file = csv_file
         self.cpu_threshold = 80.0  # CPU % threshold for alerts
         self.memory_threshold = 500.0  # Memory MB threshold for alerts
-        self.last_alert_time = 0.0
+        self.last_alert_time = float('-inf')
         os.makedirs(os.path.dirname(csv_file), exist_ok=True)
+        # Sampled straight from the Win32 process APIs; the pseudo-handle never needs closing
+        self._handle = win32api.GetCurrentProcess()
+        self._prev_cpu_time, self._prev_wall = self._cpu_time(), time.monotonic()  # CPU baseline
+        # Smoothed readings drive the sampling interval: back off when idle, tighten near thresholds
+        self._ewma_cpu: Optional[float] = None
+        self._ewma_mem: Optional[float] = None
+        self.min_interval = 10
+        self.max_interval = 60
+        self.next_interval = self.min_interval
+        # Rows are buffered and appended in batches to avoid an open/write/close per sample.
+        # The buffer keeps at most 10 batches, dropping the oldest rows if CSV writes keep failing.
+        self._flush_every = int(os.getenv("CSV_FLUSH_EVERY", "60"))
+        self._max_pending = self._flush_every * 10
+        self._pending: Deque[Tuple[str, float, float]] = deque(maxlen=self._max_pending)
+        self._pending_lock = Lock()  # flush() also runs on the SvcStop thread
+        self._flush_lock = Lock()  # Serializes rotation and writes between those threads
+        # Size and day of the current CSV, tracked in-process to decide rotation without stat calls
+        try:
+            st = os.stat(csv_file)
+            self._csv_bytes = st.st_size
+            self._csv_day = time.localtime(st.st_mtime).tm_mday
+        except FileNotFoundError:
+            self._csv_bytes = 0
+            self._csv_day = time.localtime().tm_mday
 
     def log_resource_usage(self) -> None:
-        """Log CPU and memory usage to CSV and check thresholds."""
+        """Record CPU and memory usage (flushed to CSV in batches) and check thresholds."""
         try:
-            process = psutil.Process(os.getpid())
-            cpu_percent = process.cpu_percent(interval=1.0)
-            memory_info = process.memory_info()
-            memory_usage_mb = memory_info.rss / (1024 * 1024)
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            cpu_time, wall = self._cpu_time(), time.monotonic()
+            # Percent of one core, as psutil reported it (can exceed 100 on multiple cores)
+            elapsed = wall - self._prev_wall
+            cpu_percent = 100.0 * (cpu_time - self._prev_cpu_time) / elapsed if elapsed > 0 else 0.0
+            self._prev_cpu_time, self._prev_wall = cpu_time, wall
+            memory_info = win32process.GetProcessMemoryInfo(self._handle)
+            memory_usage_mb = memory_info["WorkingSetSize"] / (1024 * 1024)
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
 
             # Check thresholds and send alert if exceeded (rate-limited to once per 5 min)
-            current_time = time.time()
+            current_time = time.monotonic()
             if (cpu_percent > self.cpu_threshold or memory_usage_mb > self.memory_threshold) and \
                (current_time - self.last_alert_time >= 300):
-                send_email(
+                enqueue_email(
                     SMTP_SERVER, SMTP_PORT, EMAIL_FROM, ERROR_EMAIL_TO,
                     "Resource Usage Alert",
                     f"High resource usage detected: CPU {cpu_percent:.2f}%, Memory {memory_usage_mb:.2f} MB",
@@ -57,27 +87,81 @@ class ResourceMonitor:
                 )
                 self.last_alert_time = current_time
 
+            self._update_interval(cpu_percent, memory_usage_mb)
+            with self._pending_lock:
+                self._pending.append((timestamp, cpu_percent, memory_usage_mb))
+                flush_due = len(self._pending) >= self._flush_every
+            if flush_due:
+                self.flush()
+            logging.info(f"Resource usage logged: CPU {cpu_percent:.2f}%, Memory {memory_usage_mb:.2f} MB")
+        except Exception as e:
+            tb = mask_traceback(traceback.format_exc())
+            logging.error(f"Failed to log resource usage: {e}\n{tb}")
+
+    def _cpu_time(self) -> float:
+        """Return total kernel + user CPU seconds used by this process."""
+        times = win32process.GetProcessTimes(self._handle)
+        return (times["KernelTime"] + times["UserTime"]) / 10_000_000  # 100 ns units
+
+    def _update_interval(self, cpu_percent: float, memory_usage_mb: float) -> None:
+        """Update the EWMA readings and derive the next sampling interval from threshold headroom."""
+        alpha = 0.2
+        if self._ewma_cpu is None or self._ewma_mem is None:
+            self._ewma_cpu, self._ewma_mem = cpu_percent, memory_usage_mb
+        else:
+            self._ewma_cpu = alpha * cpu_percent + (1 - alpha) * self._ewma_cpu
+            self._ewma_mem = alpha * memory_usage_mb + (1 - alpha) * self._ewma_mem
+        # Headroom as percent of each threshold so CPU % and memory MB are comparable
+        headroom = min(
+            100 * (self.cpu_threshold - self._ewma_cpu) / self.cpu_threshold,
+            100 * (self.memory_threshold - self._ewma_mem) / self.memory_threshold
+        )
+        self.next_interval = min(max(self.min_interval + 5 * headroom, self.min_interval), self.max_interval)
+
+    def flush(self) -> None:
+        """Append buffered samples to the CSV, rotating it first if needed."""
+        with self._flush_lock:
+            # Take the rows out so sampling can keep appending while the file is written
+            with self._pending_lock:
+                rows = list(self._pending)
+                self._pending.clear()
+            if rows:
+                self._write_rows(rows)
+
+    def _write_rows(self, rows: List[Tuple[str, float, float]]) -> None:
+        """Write rows to the CSV; on failure put them back ahead of newer samples."""
+        try:
+            # One stat for existence; size and day come from the in-process tracking
+            try:
+                os.stat(self.csv_file)
+                exists = True
+            except FileNotFoundError:
+                exists = False
+
             # Rotate CSV file based on size (5MB) or daily
             MAX_CSV_SIZE = 5 * 1024 * 1024
-            if os.path.exists(self.csv_file) and (
-                os.path.getsize(self.csv_file) > MAX_CSV_SIZE or
-                datetime.now().day != datetime.fromtimestamp(os.path.getmtime(self.csv_file)).day
-            ):
-                os.rename(self.csv_file, f"{self.csv_file}.{datetime.now().strftime('%Y%m%d_%H%M%S')}.bak")
+            if exists and (self._csv_bytes > MAX_CSV_SIZE or time.localtime().tm_mday != self._csv_day):
+                os.rename(self.csv_file, f"{self.csv_file}.{time.strftime('%Y%m%d_%H%M%S')}.bak")
                 self._create_csv()
-
-            # Create CSV if it doesn't exist
-            if not os.path.exists(self.csv_file):
+            elif not exists:
+                # Create CSV if it doesn't exist
                 self._create_csv()
 
             # Append data
             with open(self.csv_file, 'a', newline='') as csvfile:
                 writer = csv.writer(csvfile)
-                writer.writerow([timestamp, cpu_percent, memory_usage_mb])
-            logging.info(f"Resource usage logged: CPU {cpu_percent:.2f}%, Memory {memory_usage_mb:.2f} MB")
+                writer.writerows(rows)
+                self._csv_bytes = csvfile.tell()
+            logging.info(f"Flushed {len(rows)} resource samples to CSV")
         except Exception as e:
             tb = mask_traceback(traceback.format_exc())
-            logging.error(f"Failed to log resource usage: {e}\n{tb}")
+            logging.error(f"Failed to write resource usage CSV: {e}\n{tb}")
+            with self._pending_lock:
+                # Constructing with maxlen keeps the newest rows when over the cap
+                dropped = max(len(rows) + len(self._pending) - self._max_pending, 0)
+                self._pending = deque(rows + list(self._pending), maxlen=self._max_pending)
+            if dropped:
+                logging.warning(f"Resource sample buffer full, dropped {dropped} oldest samples")
 
     def _create_csv(self) -> None:
         """Create a new CSV file with headers."""
@@ -85,6 +169,8 @@ class ResourceMonitor:
             writer = csv.writer(csvfile)
             writer.writerow(["Timestamp", "CPU Percent", "Memory Usage (MB)"])
             os.chmod(self.csv_file, 0o600)
+            self._csv_bytes = csvfile.tell()
+        self._csv_day = time.localtime().tm_mday
         logging.info("Created new CSV file")
 
 class FileWatcher:
@@ -104,7 +190,7 @@ class FileWatcher:
             return False
         try:
             self.event_handler = WirePDFHandler(self.temp_dir, self.email_from, self.smtp_server, self.smtp_port)
-            self.observer = Observer()
+            self.observer = self._create_observer()
             self.observer.schedule(self.event_handler, self.watch_dir, recursive=False)
             retry_attempts = 3
             for attempt in range(retry_attempts):
@@ -117,7 +203,7 @@ class FileWatcher:
                     logging.error(f"Observer start attempt {attempt+1} failed: {e}\n{tb}")
                     time.sleep(10)
             logging.error("Failed to start observer after 3 attempts")
-            send_email(
+            enqueue_email(
                 SMTP_SERVER, SMTP_PORT, EMAIL_FROM, ERROR_EMAIL_TO,
                 "PDF Watcher Service Failed to Start",
                 "The service couldn’t start watching the folder after 3 tries.",
@@ -146,6 +232,20 @@ class FileWatcher:
             self.event_handler.cleanup_temp_dir()
             self.event_handler.cleanup_recent_filenames()
 
+    def _create_observer(self) -> Observer:
+        """Use native ReadDirectoryChangesW events locally, a slow PollingObserver on network shares."""
+        try:
+            drive = os.path.splitdrive(os.path.abspath(self.watch_dir))[0]
+            is_remote = win32file.GetDriveType(drive + "\\") == win32con.DRIVE_REMOTE
+        except Exception as e:
+            logging.warning(f"Could not determine drive type for WATCH_DIR, using native observer: {e}")
+            is_remote = False
+        if is_remote:
+            poll_interval = int(os.getenv("WATCH_POLL_INTERVAL", "30"))  # Configurable poll interval for shares
+            logging.info(f"WATCH_DIR is on a network drive, polling every {poll_interval}s")
+            return PollingObserver(timeout=poll_interval)
+        return Observer()
+
     def _validate_dirs(self) -> bool:
         """Validate watch and temp directories."""
         if not os.path.exists(self.watch_dir):
@@ -185,13 +285,15 @@ class ServiceManager(win32serviceutil.ServiceFramework):
         if ctrl_type == win32con.CTRL_SHUTDOWN_EVENT:
             logging.info("System shutdown detected")
             self.is_shutting_down = True
-            stop_message = f"The PDF Watcher Service is stopping due to system shutdown at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}."
-            send_email(
+            stop_message = f"The PDF Watcher Service is stopping due to system shutdown at {time.strftime('%Y-%m-%d %H:%M:%S')}."
+            enqueue_email(
                 SMTP_SERVER, SMTP_PORT, EMAIL_FROM, ERROR_EMAIL_TO,
                 "PDF Watcher Service Stopped (Shutdown)", stop_message,
                 use_ssl=(SMTP_PORT == 465)
             )
+            self.resource_monitor.flush()
             self.file_watcher.stop()
+            flush_email_queue()
             win32event.SetEvent(self.stop_event)
             return True
         elif ctrl_type == win32con.CTRL_LOGOFF_EVENT:
@@ -203,14 +305,18 @@ class ServiceManager(win32serviceutil.ServiceFramework):
         """Handle service stop requests."""
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
         logging.info("Service stop requested via SCM")
-        stop_message = f"The PDF Watcher Service stopped at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}."
-        send_email(
+        stop_message = f"The PDF Watcher Service stopped at {time.strftime('%Y-%m-%d %H:%M:%S')}."
+        enqueue_email(
             SMTP_SERVER, SMTP_PORT, EMAIL_FROM, ERROR_EMAIL_TO,
             "PDF Watcher Service Stopped", stop_message,
             use_ssl=(SMTP_PORT == 465)
         )
         win32event.SetEvent(self.stop_event)
         self.file_watcher.stop()
+        self.resource_monitor.flush()
+        flush_email_queue()
+        close_smtp_connections()
+        stop_logging()
         self.ReportServiceStatus(win32service.SERVICE_STOPPED)
 
     def SvcDoRun(self) -> None:
@@ -226,12 +332,13 @@ class ServiceManager(win32serviceutil.ServiceFramework):
         except Exception as e:
             tb = mask_traceback(traceback.format_exc())
             logging.error(f"Service crashed unexpectedly: {e}\n{tb}")
-            send_email(
+            enqueue_email(
                 SMTP_SERVER, SMTP_PORT, EMAIL_FROM, ERROR_EMAIL_TO,
                 "PDF Watcher Service Crash",
-                f"Service crashed at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {e}\n{tb}",
+                f"Service crashed at {time.strftime('%Y-%m-%d %H:%M:%S')}: {e}\n{tb}",
                 use_ssl=(SMTP_PORT == 465)
             )
+            flush_email_queue()
 
     def main(self) -> None:
         """Main service loop."""
@@ -239,29 +346,29 @@ class ServiceManager(win32serviceutil.ServiceFramework):
             self.SvcStop()
             return
 
-        start_message = f"The PDF Watcher Service started successfully at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}."
-        send_email(
+        start_message = f"The PDF Watcher Service started successfully at {time.strftime('%Y-%m-%d %H:%M:%S')}."
+        enqueue_email(
             SMTP_SERVER, SMTP_PORT, EMAIL_FROM, ERROR_EMAIL_TO,
             "PDF Watcher Service Started", start_message,
             use_ssl=(SMTP_PORT == 465)
         )
 
         cleanup_interval = int(os.getenv("CLEANUP_INTERVAL", "3600"))  # Configurable cleanup interval
-        resource_log_interval = 10
-        sleep_interval = float(os.getenv("SLEEP_INTERVAL", "0.1"))  # Configurable sleep interval
-        last_cleanup_time = time.time()
-        last_resource_log_time = time.time()
+        last_cleanup_time = time.monotonic()
+        last_resource_log_time = time.monotonic()
+        next_wake_ms = 100
 
         try:
             while True:
-                if win32event.WaitForSingleObject(self.stop_event, 500) == win32event.WAIT_OBJECT_0:
+                # Block until stopped or the next scheduled task is due (no separate sleep)
+                if win32event.WaitForSingleObject(self.stop_event, next_wake_ms) == win32event.WAIT_OBJECT_0:
                     logging.info("Stop event received in main loop")
                     break
                 if not self.file_watcher.is_alive() and not self.is_shutting_down:
                     logging.warning("Observer stopped unexpectedly, attempting restart")
                     self.file_watcher.stop()
                     if not self.file_watcher.start():
-                        send_email(
+                        enqueue_email(
                             SMTP_SERVER, SMTP_PORT, EMAIL_FROM, ERROR_EMAIL_TO,
                             "PDF Watcher Service Observer Failure",
                             "Observer failed to restart.",
@@ -269,24 +376,32 @@ class ServiceManager(win32serviceutil.ServiceFramework):
                         )
                         self.SvcStop()
                         return
-                current_time = time.time()
+                current_time = time.monotonic()
                 if current_time - last_cleanup_time >= cleanup_interval:
                     self.file_watcher.cleanup()
                     last_cleanup_time = current_time
-                if current_time - last_resource_log_time >= resource_log_interval:
+                if current_time - last_resource_log_time >= self.resource_monitor.next_interval:
                     self.resource_monitor.log_resource_usage()
                     last_resource_log_time = current_time
-                time.sleep(sleep_interval)
+                now = time.monotonic()
+                seconds_to_next_task = min(
+                    cleanup_interval - (now - last_cleanup_time),
+                    self.resource_monitor.next_interval - (now - last_resource_log_time)
+                )
+                # Capped at 5 s so observer health is still checked regularly
+                next_wake_ms = int(min(max(seconds_to_next_task * 1000, 100), 5000))
         except Exception as e:
             tb = mask_traceback(traceback.format_exc())
             logging.error(f"Unexpected error in main loop: {e}\n{tb}")
-            send_email(
+            enqueue_email(
                 SMTP_SERVER, SMTP_PORT, EMAIL_FROM, ERROR_EMAIL_TO,
                 "PDF Watcher Service Error", f"Unexpected error: {e}\n{tb}",
                 use_ssl=(SMTP_PORT == 465)
             )
         finally:
             self.file_watcher.stop()
+            self.resource_monitor.flush()
+            flush_email_queue()
             logging.info("PDF Watcher Service stopped")
 
 if __name__ == '__main__':
@@ -9,16 +9,52 @@ Last Modified: 5/29/2025
 
 import os
 import re
+import sys
+import string
+import unicodedata
 import time
 import logging
-import xml.etree.ElementTree as ET
-from typing import Optional, Dict
+from collections import OrderedDict
+from threading import Lock
+from lxml import etree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Tuple, List, Sequence
 
 from config import mask_path, EMAIL_DOMAIN
 
-# Cache for XML parsing failures to avoid repeated attempts
-XML_ERROR_CACHE: Dict[str, float] = {}
+# Module logger; messages use lazy %-formatting, and INFO/DEBUG sites that mask paths
+# check isEnabledFor first so mask_path only runs when the record is emitted
+_log = logging.getLogger(__name__)
+
+# Cache for XML parsing failures to avoid repeated attempts, keyed by (path, mtime_ns)
+# so a rewritten file is retried immediately; least recently failed entries are evicted
+XML_ERROR_CACHE: "OrderedDict[Tuple[str, int], float]" = OrderedDict()
 XML_CACHE_TIMEOUT = 300  # 5 minutes
+XML_ERROR_CACHE_SIZE = 4096
+_xml_error_cache_lock = Lock()  # Parses run on the handler's executor threads
+
+# Used by transform_name_to_email: a translate table dropping every ASCII character
+# except A-Z, 0-9 and '.', and the pattern collapsing runs of dots
+_EMAIL_PREFIX_ALLOWED = frozenset(string.ascii_uppercase + string.digits + '.')
+_EMAIL_PREFIX_DROP = str.maketrans('', '', ''.join(chr(i) for i in range(128) if chr(i) not in _EMAIL_PREFIX_ALLOWED))
+_DOT_RUN = re.compile(r'\.+')
+
+# User name fields in priority order, normalized (uppercase, no spaces or underscores)
+USER_NAME_FIELDS = ('USERNAME', 'USER', 'SUBMITTER', 'SUBMITTEDBY')
+_FIELD_SEPARATORS = re.compile(r'[\s_]+')
+
+# Companion XML lookups keyed by PDF path, valid while the directory mtime is unchanged
+COMPANION_XML_CACHE: Dict[str, Tuple[int, Optional[str]]] = {}
+COMPANION_XML_CACHE_SIZE = 1024
+_companion_xml_cache_lock = Lock()
+
+# libxml2 options for every parse; entity expansion and network access stay disabled for untrusted input.
+# Comments and processing instructions are dropped, as ElementTree did, so they never look like fields.
+_ITERPARSE_OPTIONS = dict(
+    remove_blank_text=True, remove_comments=True, remove_pis=True,
+    huge_tree=False, resolve_entities=False, no_network=True
+)
+_STRATEGY_ORDER = ("direct_index_elements", "field_elements", "property_elements", "direct_child_elements")
 
 def find_companion_xml(pdf_path: str) -> Optional[str]:
     """Find the companion XML file for a given PDF file.
@@ -37,21 +73,49 @@ def find_companion_xml(pdf_path: str) -> Optional[str]:
         >>> find_companion_xml("/path/wire_12345.pdf")
         "/path/wire_12345.xml"
     """
+    # Adding or removing a file updates the directory mtime, so a cached
+    # lookup stays valid until the directory changes
+    try:
+        dir_mtime = os.stat(os.path.dirname(pdf_path) or '.').st_mtime_ns
+    except OSError:
+        dir_mtime = None
+    with _companion_xml_cache_lock:
+        cached = COMPANION_XML_CACHE.get(pdf_path)
+    if dir_mtime is not None and cached is not None and cached[0] == dir_mtime:
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("Using cached companion XML lookup for: %s", mask_path(pdf_path))
+        return cached[1]
+    xml_path = _find_companion_xml_uncached(pdf_path)
+    if dir_mtime is not None:
+        with _companion_xml_cache_lock:
+            COMPANION_XML_CACHE[pdf_path] = (dir_mtime, xml_path)
+            if len(COMPANION_XML_CACHE) > COMPANION_XML_CACHE_SIZE:
+                del COMPANION_XML_CACHE[next(iter(COMPANION_XML_CACHE))]
+    return xml_path
+
+def _companion_xml_name(pdf_name: str) -> str:
+    """Lowercased companion XML file name for a PDF base name, for case-insensitive matching."""
+    stem = pdf_name.rpartition('.')[0]
+    return (stem or pdf_name).lower() + ".xml"
+
+def _find_companion_xml_uncached(pdf_path: str) -> Optional[str]:
+    """Look for the companion XML on disk (see find_companion_xml)."""
     # Get the base filename without extension
-    base_name = os.path.splitext(pdf_path)[0]
-    xml_path = base_name + ".xml"
-    
-    if os.path.exists(xml_path):
-        logging.info(f"Found companion XML file with matching name: {mask_path(xml_path)}")
-        return xml_path
+    dir_name, pdf_name = os.path.split(pdf_path)
+    stem = pdf_name.rpartition('.')[0] or pdf_name
+    base_name = os.path.join(dir_name, stem)
     
-    # Try uppercase extension
-    xml_path_upper = base_name + ".XML"
-    if os.path.exists(xml_path_upper):
-        logging.info(f"Found companion XML file with matching name: {mask_path(xml_path_upper)}")
-        return xml_path_upper
+    # Direct stats rather than a directory listing, so the cost doesn't grow with the
+    # watch folder. On Windows the first probe already matches any extension casing;
+    # the uppercase one only matters on case-sensitive filesystems.
+    for xml_path in (base_name + ".xml", base_name + ".XML"):
+        if os.path.exists(xml_path):
+            if _log.isEnabledFor(logging.INFO):
+                _log.info("Found companion XML file with matching name: %s", mask_path(xml_path))
+            return xml_path
     
-    logging.info(f"No companion XML file with matching name found for: {mask_path(pdf_path)}")
+    if _log.isEnabledFor(logging.INFO):
+        _log.info("No companion XML file with matching name found for: %s", mask_path(pdf_path))
     return None
 
 def parse_synergy_xml(xml_path: str) -> Optional[Dict[str, str]]:
@@ -63,6 +127,9 @@ def parse_synergy_xml(xml_path: str) -> Optional[Dict[str, str]]:
     - Property elements: <property name="USER NAME" value="John Doe"/>
     - Direct child elements: <USER_NAME>John Doe</USER_NAME>
     
+    Structures are tried in that order and the first one that yields
+    values is returned; later structures are only a fallback.
+    
     Args:
         xml_path: Full path to the XML file to parse
         
@@ -73,89 +140,123 @@ def parse_synergy_xml(xml_path: str) -> Optional[Dict[str, str]]:
         >>> parse_synergy_xml("/path/wire_12345.xml")
         {"USER NAME": "John Doe", "ACCOUNT": "123456"}
     """
-    # Check error cache first
-    current_time = time.time()
-    if xml_path in XML_ERROR_CACHE:
-        if current_time - XML_ERROR_CACHE[xml_path] < XML_CACHE_TIMEOUT:
-            logging.debug(f"Skipping recently failed XML file: {mask_path(xml_path)}")
-            return None
-        else:
+    try:
+        mtime_ns = os.stat(xml_path).st_mtime_ns
+    except OSError as e:
+        _log.error("Error processing XML file %s: %s", mask_path(xml_path), e)
+        return None
+    cache_key = (xml_path, mtime_ns)
+    # Check error cache first; the clock is only read when there is an entry to age
+    with _xml_error_cache_lock:
+        failed_at = XML_ERROR_CACHE.get(cache_key)
+        recently_failed = failed_at is not None and time.monotonic() - failed_at < XML_CACHE_TIMEOUT
+        if failed_at is not None and not recently_failed:
             # Cache entry expired, remove it
-            del XML_ERROR_CACHE[xml_path]
+            del XML_ERROR_CACHE[cache_key]
+    if recently_failed:
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("Skipping recently failed XML file: %s", mask_path(xml_path))
+        return None
     try:
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-        
-        # Dictionary to store index values
-        indexes = {}
-        strategies_tried = []
-        
-        # Common XML structures for Synergy
-        # Try different possible XML structures
+        # Field names repeat across every Synergy XML, so keys are interned to share one string each.
+        # Results per structure; the first one (in _STRATEGY_ORDER) that yields data is used.
+        # Synergy files use a single layout, so lower-priority structures are only collected
+        # while every higher-priority one is still empty.
+        index_values: Dict[str, str] = {}
+        field_values: Dict[str, str] = {}
+        prop_values: Dict[str, str] = {}
+        child_values: Dict[str, str] = {}
+        strategies_seen = set()
         
-        # Structure 1: Direct index elements
-        index_elements = root.findall('.//index')
-        if index_elements:
-            strategies_tried.append("direct_index_elements")
-        for index in index_elements:
-            name = index.get('name') or index.find('name')
-            value = index.get('value') or index.find('value')
-            if name and value:
-                if isinstance(name, ET.Element):
-                    name = name.text
-                if isinstance(value, ET.Element):
-                    value = value.text
-                if name and value:
-                    indexes[name] = value
+        # Single streaming pass; handled elements are cleared so memory stays flat on large batches
+        with open(xml_path, 'rb') as xml_file:
+            for _, elem in ET.iterparse(xml_file, events=('end',), **_ITERPARSE_OPTIONS):
+                tag = elem.tag
+                handled = True
+                
+                # Structure 1: Direct index elements
+                if tag == 'index':
+                    strategies_seen.add("direct_index_elements")
+                    # Attribute form first, then a <name>/<value> child element
+                    name = elem.get('name')
+                    if not name:
+                        sub = elem.find('name')
+                        name = sub.text if sub is not None else None
+                    value = elem.get('value')
+                    if not value:
+                        sub = elem.find('value')
+                        value = sub.text if sub is not None else None
+                    if name and value:
+                        index_values[sys.intern(name)] = value
+                
+                # Structure 2: Field elements
+                elif tag == 'field':
+                    strategies_seen.add("field_elements")
+                    if not index_values:
+                        name = elem.get('name')
+                        value = elem.text
+                        if name and value:
+                            field_values[sys.intern(name)] = value
+                
+                # Structure 3: Property elements
+                elif tag == 'property':
+                    strategies_seen.add("property_elements")
+                    if not (index_values or field_values):
+                        name = elem.get('name')
+                        value = elem.get('value') or elem.text
+                        if name and value:
+                            prop_values[sys.intern(name)] = value
+                else:
+                    handled = False
+                
+                # Structure 4: Direct child elements with tag as name
+                parent = elem.getparent()
+                if parent is not None and parent.getparent() is None:
+                    strategies_seen.add("direct_child_elements")
+                    if not (index_values or field_values or prop_values) and elem.text and elem.text.strip():
+                        child_values[sys.intern(tag)] = elem.text.strip()
+                    elem.clear(keep_tail=True)
+                    # Earlier siblings are fully processed; drop them from the root
+                    while elem.getprevious() is not None:
+                        del parent[0]
+                elif handled:
+                    elem.clear(keep_tail=True)
         
-        # Structure 2: Field elements
-        field_elements = root.findall('.//field')
-        if field_elements:
-            strategies_tried.append("field_elements")
-        for field in field_elements:
-            name = field.get('name')
-            value = field.text
-            if name and value:
-                indexes[name] = value
+        for strategy, indexes in zip(_STRATEGY_ORDER, (index_values, field_values, prop_values, child_values)):
+            if indexes:
+                _log.info("Extracted %d index values from XML using strategy: %s", len(indexes), strategy)
+                return indexes
         
-        # Structure 3: Property elements
-        prop_elements = root.findall('.//property')
-        if prop_elements:
-            strategies_tried.append("property_elements")
-        for prop in prop_elements:
-            name = prop.get('name')
-            value = prop.get('value') or prop.text
-            if name and value:
-                indexes[name] = value
-        
-        # Structure 4: Direct child elements with tag as name
-        if list(root):
-            strategies_tried.append("direct_child_elements")
-        for child in root:
-            if child.text and child.text.strip():
-                indexes[child.tag] = child.text.strip()
-        
-        if strategies_tried:
-            logging.info(f"Extracted {len(indexes)} index values from XML using strategies: {', '.join(strategies_tried)}")
+        if strategies_seen:
+            strategies_tried = [s for s in _STRATEGY_ORDER if s in strategies_seen]
+            _log.info("Extracted 0 index values from XML using strategies: %s", ', '.join(strategies_tried))
         else:
-            logging.warning(f"No XML parsing strategies were applicable for: {mask_path(xml_path)}")
-        
-        return indexes if indexes else None
+            _log.warning("No XML parsing strategies were applicable for: %s", mask_path(xml_path))
+        return None
         
-    except ET.ParseError as e:
-        logging.error(f"Failed to parse XML file {mask_path(xml_path)}: {e}")
-        XML_ERROR_CACHE[xml_path] = current_time
+    except ET.ParseError as e:  # Base of lxml's XMLSyntaxError
+        _log.error("Failed to parse XML file %s: %s", mask_path(xml_path), e)
+        _record_xml_error(cache_key, time.monotonic())
         return None
-    except Exception as e:
-        logging.error(f"Error processing XML file {mask_path(xml_path)}: {e}")
-        XML_ERROR_CACHE[xml_path] = current_time
+    except OSError as e:  # Includes PermissionError
+        _log.error("Error processing XML file %s: %s", mask_path(xml_path), e)
+        _record_xml_error(cache_key, time.monotonic())
         return None
 
+def _record_xml_error(cache_key: Tuple[str, int], failed_at: float) -> None:
+    """Remember a failed parse, evicting the oldest entry once the cache is full."""
+    with _xml_error_cache_lock:
+        XML_ERROR_CACHE[cache_key] = failed_at
+        XML_ERROR_CACHE.move_to_end(cache_key)
+        if len(XML_ERROR_CACHE) > XML_ERROR_CACHE_SIZE:
+            XML_ERROR_CACHE.popitem(last=False)
+
 def extract_user_name(indexes: Dict[str, str]) -> Optional[str]:
     """Extract user name from index values.
     
     Searches for user name in common field variations used by Synergy.
-    Field names are matched case-insensitively.
+    Field names are matched ignoring case, spaces and underscores, so
+    "User Name", "USER_NAME" and "username" are all the same field.
     
     Args:
         indexes: Dictionary of field names to values from XML parsing
@@ -167,25 +268,24 @@ def extract_user_name(indexes: Dict[str, str]) -> Optional[str]:
         >>> extract_user_name({"USER NAME": "John Doe", "ACCOUNT": "123456"})
         "John Doe"
     """
-    # Try different possible field names for user
-    possible_fields = [
-        'USER NAME', 'USER_NAME', 'UserName', 'User Name',
-        'USERNAME', 'user_name', 'username', 'User',
-        'SUBMITTER', 'Submitter', 'submitter',
-        'SUBMITTED_BY', 'SubmittedBy', 'Submitted By'
-    ]
+    # Normalize field names once; the first non-empty value for each normalized name wins
+    normalized: Dict[str, Tuple[str, str]] = {}
+    for field, value in indexes.items():
+        user_name = value.strip()
+        if user_name:
+            normalized.setdefault(_FIELD_SEPARATORS.sub('', field).upper(), (field, user_name))
     
-    for field in possible_fields:
-        if field in indexes:
-            user_name = indexes[field].strip()
-            if user_name:
-                logging.info(f"Found user name in field '{field}': [REDACTED]")
-                return user_name
+    for key in USER_NAME_FIELDS:
+        match = normalized.get(key)
+        if match:
+            field, user_name = match
+            _log.info("Found user name in field '%s': [REDACTED]", field)
+            return user_name
     
-    logging.warning("No user name found in XML indexes")
+    _log.warning("No user name found in XML indexes")
     return None
 
-def transform_name_to_email(user_name: str, email_domain: Optional[str] = None) -> Optional[str]:
+def transform_name_to_email(user_name: str, email_domain: str = EMAIL_DOMAIN) -> Optional[str]:
     """Transform a user name to email format.
     
     Converts names to uppercase email format with dots between name parts.
@@ -204,14 +304,12 @@ def transform_name_to_email(user_name: str, email_domain: Optional[str] = None)
         >>> transform_name_to_email("Jane Smith-Wilson", "COMPANY.COM") 
         "JANE.SMITHWILSON@COMPANY.COM"
     """
-    if email_domain is None:
-        email_domain = EMAIL_DOMAIN
     try:
         # Remove extra spaces and split the name
         name_parts = user_name.strip().split()
         
         if not name_parts:
-            logging.warning("Empty user name provided")
+            _log.warning("Empty user name provided")
             return None
         
         # Handle different name formats
@@ -220,33 +318,42 @@ def transform_name_to_email(user_name: str, email_domain: Optional[str] = None)
             email_prefix = name_parts[0].upper()
         elif len(name_parts) == 2:
             # First Last format
-            email_prefix = f"{name_parts[0]}.{name_parts[1]}".upper()
+            first, last = name_parts
+            if first.isascii() and last.isascii() and first.isalpha() and last.isalpha():
+                # Plain ASCII letters (the usual case) need no sanitizing
+                email = f"{first.upper()}.{last.upper()}@{email_domain}"
+                _log.info("Transformed user name to email: [REDACTED]@%s", email_domain)
+                return email
+            email_prefix = f"{first}.{last}".upper()
         else:
             # Multiple parts - use first and last
             email_prefix = f"{name_parts[0]}.{name_parts[-1]}".upper()
         
-        # Remove any non-alphanumeric characters except dots
-        email_prefix = re.sub(r'[^A-Z0-9.]', '', email_prefix)
+        # Fold accents to ASCII and drop anything else non-ASCII, then
+        # remove any non-alphanumeric characters except dots
+        if not email_prefix.isascii():
+            email_prefix = unicodedata.normalize('NFKD', email_prefix).encode('ascii', 'ignore').decode('ascii')
+        email_prefix = email_prefix.translate(_EMAIL_PREFIX_DROP)
         
         # Ensure no multiple consecutive dots
-        email_prefix = re.sub(r'\.+', '.', email_prefix)
+        email_prefix = _DOT_RUN.sub('.', email_prefix)
         
         # Remove leading/trailing dots
         email_prefix = email_prefix.strip('.')
         
         if not email_prefix:
-            logging.warning("Could not create valid email prefix from user name")
+            _log.warning("Could not create valid email prefix from user name")
             return None
         
         email = f"{email_prefix}@{email_domain}"
-        logging.info(f"Transformed user name to email: [REDACTED]@{email_domain}")
+        _log.info("Transformed user name to email: [REDACTED]@%s", email_domain)
         return email
         
     except Exception as e:
-        logging.error(f"Error transforming name to email: {e}")
+        _log.error("Error transforming name to email: %s", e)
         return None
 
-def get_user_email_from_xml(pdf_path: str, email_domain: Optional[str] = None) -> Optional[str]:
+def get_user_email_from_xml(pdf_path: str, email_domain: str = EMAIL_DOMAIN) -> Optional[str]:
     """Extract user email from companion XML file.
     
     Complete workflow for extracting user email from XML metadata:
@@ -266,13 +373,83 @@ def get_user_email_from_xml(pdf_path: str, email_domain: Optional[str] = None) -
         >>> get_user_email_from_xml("/path/wire_12345.pdf", "COMPANY.COM")
         "JOHN.DOE@COMPANY.COM"
     """
-    if email_domain is None:
-        email_domain = EMAIL_DOMAIN
     # Find companion XML
     xml_path = find_companion_xml(pdf_path)
     if not xml_path:
         return None
     
+    return get_user_email_from_companion_xml(xml_path, email_domain)
+
+def get_user_emails_from_xml(pdf_paths: Sequence[str], email_domain: str = EMAIL_DOMAIN) -> Dict[str, Optional[str]]:
+    """Extract user emails for a batch of PDFs, e.g. a folder of wires dropped at once.
+    
+    Each parent directory is listed once to find all companion XMLs, and the
+    XMLs are parsed in parallel (lxml releases the GIL while parsing).
+    
+    Args:
+        pdf_paths: Full paths to the PDF files
+        email_domain: Email domain to use (defaults to EMAIL_DOMAIN config)
+        
+    Returns:
+        Dictionary mapping each PDF path to its user email, or None if
+        extraction failed for that PDF (an error on one PDF never aborts
+        the rest of the batch)
+        
+    Example:
+        >>> get_user_emails_from_xml(["/path/wire_1.pdf", "/path/wire_2.pdf"], "COMPANY.COM")
+        {"/path/wire_1.pdf": "JOHN.DOE@COMPANY.COM", "/path/wire_2.pdf": None}
+    """
+    results: Dict[str, Optional[str]] = {pdf_path: None for pdf_path in pdf_paths}
+    by_dir: Dict[str, List[str]] = {}
+    for pdf_path in results:
+        by_dir.setdefault(os.path.dirname(pdf_path), []).append(pdf_path)
+    
+    # Find companion XMLs with one directory listing per folder
+    xml_paths: Dict[str, str] = {}
+    for dir_name, dir_pdfs in by_dir.items():
+        try:
+            with os.scandir(dir_name or '.') as entries:
+                names = {entry.name.lower(): entry.name for entry in entries}
+        except OSError as e:
+            _log.warning("Could not list directory for companion XMLs of %d PDFs: %s", len(dir_pdfs), e)
+            continue
+        for pdf_path in dir_pdfs:
+            xml_name = names.get(_companion_xml_name(os.path.basename(pdf_path)))
+            if xml_name:
+                xml_paths[pdf_path] = os.path.join(dir_name, xml_name)
+    
+    if xml_paths:
+        with ThreadPoolExecutor(max_workers=min(len(xml_paths), os.cpu_count() or 1)) as executor:
+            emails = executor.map(_batch_user_email, xml_paths.values(), [email_domain] * len(xml_paths))
+            results.update(zip(xml_paths.keys(), emails))
+    _log.info("Resolved %d of %d user emails from companion XMLs", sum(1 for e in results.values() if e), len(results))
+    return results
+
+def _batch_user_email(xml_path: str, email_domain: str) -> Optional[str]:
+    """get_user_email_from_companion_xml for one batch item; an error maps that item to None."""
+    try:
+        return get_user_email_from_companion_xml(xml_path, email_domain)
+    except Exception as e:
+        _log.error("Unexpected error extracting user email from %s: %s", mask_path(xml_path), e)
+        return None
+
+def get_user_email_from_companion_xml(xml_path: str, email_domain: str = EMAIL_DOMAIN) -> Optional[str]:
+    """Extract user email from an already located companion XML file.
+    
+    Runs steps 2-4 of get_user_email_from_xml. Use this when the XML path is
+    known, e.g. a temp copy whose name no longer matches the renamed PDF.
+    
+    Args:
+        xml_path: Full path to the XML file
+        email_domain: Email domain to use (defaults to EMAIL_DOMAIN config)
+        
+    Returns:
+        User email address string or None if extraction fails at any step
+        
+    Example:
+        >>> get_user_email_from_companion_xml("/path/wire_12345.xml", "COMPANY.COM")
+        "JOHN.DOE@COMPANY.COM"
+    """
     # Parse XML
     indexes = parse_synergy_xml(xml_path)
     if not indexes: